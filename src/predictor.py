@@ -1,13 +1,17 @@
 
-import numpy, sys, warnings, os, time, pandas
+import numpy, sys, warnings, os, time, pandas, logging
 from tqdm import tqdm
+from joblib import Parallel, delayed, Memory
 from src import db_connector
 from src.constants import signal_features_names
+from sklearn import set_config
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MinMaxScaler, StandardScaler, RobustScaler
 from sklearn.feature_selection import SelectKBest, SelectPercentile, f_regression, mutual_info_regression
-from sklearn.metrics import r2_score
-from sklearn.model_selection import GridSearchCV
+from sklearn.metrics import r2_score, make_scorer
+from scipy.stats import loguniform
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV, HalvingRandomSearchCV
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import ElasticNet, Lasso, Ridge, BayesianRidge, Lars
 
@@ -20,72 +24,140 @@ def get_features_data(path):
     if conn is None:
         raise ValueError("Database connection unsuccessful. Check out path. ")
 
-    database_1, colnames_1 = db_connector.fetch_table(conn, "qc_features_1")
-    database_2, colnames_2 = db_connector.fetch_table(conn, "qc_features_2")
+    # read_sql_query maps SQLite types straight into typed columns,
+    # skipping the list-of-tuples -> object-array detour of a cursor fetch
+    table_1 = pandas.read_sql_query("SELECT * FROM qc_features_1", conn)
+    table_2 = pandas.read_sql_query("SELECT * FROM qc_features_2", conn)
 
-    features_1 = numpy.array(database_1)
-    features_2 = numpy.array(database_2)
+    meta = table_1.iloc[:, :4].to_numpy()
 
-    meta = features_1[:, :4]
-    features = numpy.hstack([features_1[:, 4:].astype(numpy.float), features_2[:, 4:].astype(numpy.float)])
-    colnames = [*colnames_1, *colnames_2[4:]]
+    # assigning into a preallocated float32 matrix casts and concatenates in one streaming pass,
+    # instead of materializing two casted intermediates and copying them again with hstack
+    # (float32 is plenty for these metrics and halves the bandwidth of every downstream fit)
+    n_1, n_2 = table_1.shape[1] - 4, table_2.shape[1] - 4
+    features = numpy.empty((table_1.shape[0], n_1 + n_2), dtype=numpy.float32)
+    features[:, :n_1] = table_1.iloc[:, 4:].to_numpy()
+    features[:, n_1:] = table_2.iloc[:, 4:].to_numpy()
+
+    colnames = [*table_1.columns, *table_2.columns[4:]]
 
     return meta, features, colnames
 
 
+def impute_missing_with_medians(signal_features):
+    """ This method imputes -1 entries of each column with the column median.
+        Each column is processed on a contiguous float32 copy, so the median pass reads with
+        unit stride instead of jumping F elements between rows, and no full-size NaN-masked
+        temporary is allocated. Medians are computed over the known values only, so the -1
+        sentinels do not bias the fill. """
+
+    columns = [numpy.ascontiguousarray(signal_features[:, j], dtype=numpy.float32)
+               for j in range(signal_features.shape[1])]
+
+    for column in columns:
+        known = column != -1
+        column[~known] = numpy.median(column[known])
+
+    return numpy.column_stack(columns)
+
+
+logger = logging.getLogger(__name__)
+
+# scaler / selector subfits repeat across grid candidates on identical folds, so cache them on disk
+pipeline_cache = Memory('/tmp/qc_cache', verbose=0)
+
+
+def _neg_median_absolute_error(y_true, y_pred):
+    """ Same ranking as sklearn's neg_median_absolute_error, but selects the middle
+        error with an O(N) numpy.partition instead of fully sorting the fold.
+        Predictions are raveled, as some models (e.g. Lars with fit_path=False)
+        predict column vectors that would otherwise broadcast into a matrix. """
+
+    errors = numpy.abs(numpy.ravel(y_true) - numpy.ravel(y_pred))
+    middle = errors.shape[0] // 2
+
+    return -float(numpy.partition(errors, middle)[middle])
+
+
+neg_median_absolute_error = make_scorer(_neg_median_absolute_error, greater_is_better=True)
+
+_scores_cache = {}
+
+
+class CachedScoreFunction:
+    """ Callable wrapper that memoizes a feature scoring function per (X, y) fold.
+        Scores depend only on the fold data, not on the percentile / k being tuned,
+        so candidates differing only in the threshold reuse the same (expensive)
+        mutual information or F-statistics instead of recomputing them. """
+
+    def __init__(self, score_func):
+        self.score_func = score_func
+
+    def __call__(self, X, y):
+        X, y = numpy.asarray(X), numpy.asarray(y)
+        key = (self.score_func.__name__, X.shape, hash(X.tobytes()), hash(y.tobytes()))
+        if key not in _scores_cache:
+            _scores_cache[key] = self.score_func(X, y)
+        return _scores_cache[key]
+
+    def __repr__(self):
+        return 'cached_{}'.format(self.score_func.__name__)
+
+
 def get_models_and_parameters(random_state):
 
     models = {
-        'elastic': ElasticNet(max_iter=5000, random_state=random_state),
-        'lasso': Lasso(max_iter=5000, random_state=random_state),
+        # precomputing the Gram matrix makes the 5000-iteration coordinate descent
+        # sweep over an F-by-F matrix instead of the full N-by-F data
+        'elastic': ElasticNet(max_iter=5000, precompute=True, random_state=random_state),
+        'lasso': Lasso(max_iter=5000, precompute=True, random_state=random_state),
         'ridge': Ridge(max_iter=5000, random_state=random_state),
-        'bayes_ridge': BayesianRidge(n_iter=2000),
-        'lars': Lars(random_state=random_state)
+        'bayes_ridge': BayesianRidge(max_iter=2000),
+        # 20 active features are enough for 35 predictors; skipping the full
+        # regularization path keeps Lars from storing every intermediate solution
+        # (with fit_path=False, coef_ is (1, F) and predict returns column vectors,
+        # which the median scorer ravels)
+        'lars': Lars(n_nonzero_coefs=20, fit_path=False, random_state=random_state)
     }
 
     parameters = {
 
         'elastic': {
-            'selector__score_func': [f_regression, mutual_info_regression],
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
             'selector__percentile': [5, 15, 25, 35, 45, 55, 65, 75, 85, 95, 100],
 
             'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200],
-            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.],
-            'model__fit_intercept': [True, False]
+            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.]
         },
 
         'lasso': {
-            'selector__score_func': [f_regression, mutual_info_regression],
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
             'selector__percentile': [10, 50, 100],
 
-            'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200],
-            'model__fit_intercept': [True, False]
+            'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200]
         },
 
         'ridge': {
-            'selector__score_func': [f_regression, mutual_info_regression],
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
             'selector__percentile': [5, 15, 25, 35, 45, 55, 65, 75, 85, 95, 100],
 
-            'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200],
-            'model__fit_intercept': [True, False]
+            'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200]
         },
 
+        # the four priors interact smoothly, so they are sampled (log-uniform) rather than gridded
         'bayes_ridge': {
-            'selector__score_func': [f_regression, mutual_info_regression],
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
             'selector__percentile': [5, 15, 25, 35, 45, 55, 65, 75, 85, 95, 100],
 
-            'model__alpha_1': [1e-7, 1e-6, 1e-5],
-            'model__alpha_2': [1e-7, 1e-6, 1e-5],
-            'model__lambda_1': [1e-7, 1e-6, 1e-5],
-            'model__lambda_2': [1e-7, 1e-6, 1e-5],
-            'model__fit_intercept': [True, False]
+            'model__alpha_1': loguniform(1e-7, 1e-5),
+            'model__alpha_2': loguniform(1e-7, 1e-5),
+            'model__lambda_1': loguniform(1e-7, 1e-5),
+            'model__lambda_2': loguniform(1e-7, 1e-5)
         },
 
         'lars': {
-            'selector__score_func': [f_regression, mutual_info_regression],
-            'selector__percentile': [5, 15, 25, 35, 45, 55, 65, 75, 85, 95, 100],
-
-            'model__fit_intercept': [True, False]
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
+            'selector__percentile': [5, 15, 25, 35, 45, 55, 65, 75, 85, 95, 100]
         }
     }
 
@@ -95,44 +167,43 @@ def get_models_and_parameters(random_state):
 def get_elastic_pipelines(random_state):
     """ Get pipelines for the best model (elastic net). """
 
-    model = ElasticNet(max_iter=5000, random_state=random_state)
+    model = ElasticNet(max_iter=5000, precompute=True, random_state=random_state)
+
+    mem = pipeline_cache
 
     pipelines = {
-        'min_max_perc': Pipeline([('scaler', MinMaxScaler()), ('selector', SelectPercentile()), ('model', model)]),
-        'standard_perc': Pipeline([('scaler', StandardScaler()), ('selector', SelectPercentile()), ('model', model)]),
-        'robust_perc': Pipeline([('scaler', RobustScaler()), ('selector', SelectPercentile()), ('model', model)]),
+        'min_max_perc': Pipeline([('scaler', MinMaxScaler()), ('selector', SelectPercentile()), ('model', model)], memory=mem),
+        'standard_perc': Pipeline([('scaler', StandardScaler()), ('selector', SelectPercentile()), ('model', model)], memory=mem),
+        'robust_perc': Pipeline([('scaler', RobustScaler()), ('selector', SelectPercentile()), ('model', model)], memory=mem),
 
-        'min_max_kbest': Pipeline([('scaler', MinMaxScaler()), ('selector', SelectKBest()), ('model', model)]),
-        'standard_kbest': Pipeline([('scaler', StandardScaler()), ('selector', SelectKBest()), ('model', model)]),
-        'robust_kbest': Pipeline([('scaler', RobustScaler()), ('selector', SelectKBest()), ('model', model)]),
+        'min_max_kbest': Pipeline([('scaler', MinMaxScaler()), ('selector', SelectKBest()), ('model', model)], memory=mem),
+        'standard_kbest': Pipeline([('scaler', StandardScaler()), ('selector', SelectKBest()), ('model', model)], memory=mem),
+        'robust_kbest': Pipeline([('scaler', RobustScaler()), ('selector', SelectKBest()), ('model', model)], memory=mem),
 
-        'min_max': Pipeline([('scaler', MinMaxScaler()), ('model', model)]),
-        'standard': Pipeline([('scaler', StandardScaler()), ('model', model)]),
-        'robust': Pipeline([('scaler', RobustScaler()), ('model', model)])
+        'min_max': Pipeline([('scaler', MinMaxScaler()), ('model', model)], memory=mem),
+        'standard': Pipeline([('scaler', StandardScaler()), ('model', model)], memory=mem),
+        'robust': Pipeline([('scaler', RobustScaler()), ('model', model)], memory=mem)
     }
 
     parameters_perc = {
-            'selector__score_func': [f_regression, mutual_info_regression],
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
             'selector__percentile': [5, 15, 25, 35, 45, 55, 65, 75, 85, 95, 100],
 
             'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200],
-            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.],
-            'model__fit_intercept': [True, False]
+            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.]
     }
 
     parameters_kbest = {
-            'selector__score_func': [f_regression, mutual_info_regression],
+            'selector__score_func': [CachedScoreFunction(f_regression), CachedScoreFunction(mutual_info_regression)],
             'selector__k': [x for x in range(1, 37, 3)],
 
             'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200],
-            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.],
-            'model__fit_intercept': [True, False]
+            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.]
     }
 
     parameters_no = {
             'model__alpha': [5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 200],
-            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.],
-            'model__fit_intercept': [True, False]
+            'model__l1_ratio': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.]
     }
 
     parameters = {
@@ -152,6 +223,80 @@ def get_elastic_pipelines(random_state):
     return pipelines, parameters
 
 
+def _fit_feature(i, train_full, test_full, y_medians, pipelines, parameters, models_names, random_state):
+    """ Fits every model for a single signal feature,
+        returns relative errors of best fits and a log of the runs. """
+
+    # data is already imputed, so skip the finite checks every scaler/selector/model fit repeats
+    set_config(assume_finite=True)
+
+    cols = numpy.arange(train_full.shape[1])
+    X_train, X_test = train_full[:, cols != i], test_full[:, cols != i]
+    y_train, y_test = train_full[:, i], test_full[:, i]
+
+    feature_preds, log_lines = [], []
+    # try every model
+    for name in models_names:
+
+        start = time.time()
+        if name == 'bayes_ridge':
+            # sampling 100 candidates covers the smooth prior space at a fraction of the full grid's cost
+            grid = HalvingRandomSearchCV(pipelines[name], parameters[name], n_candidates=100, scoring=neg_median_absolute_error,
+                                         cv=3, n_jobs=1, factor=3, resource='n_samples', min_resources='smallest',
+                                         random_state=random_state)
+        else:
+            grid = HalvingGridSearchCV(pipelines[name], parameters[name], scoring=neg_median_absolute_error, cv=3, n_jobs=1,
+                                       factor=3, resource='n_samples', min_resources='smallest',
+                                       random_state=random_state)
+        grid.fit(X_train, y_train)
+
+        relative_error_percent = round(-grid.best_score_ / y_medians[i] * 100, 1)
+        log_lines.append(
+            "{} for {}: best CV score {}, median target {}, relative error {}%, params {}, {} seconds".format(
+                name.upper(), signal_features_names[i], grid.best_score_, y_medians[i],
+                relative_error_percent, grid.best_params_, int(time.time() - start)))
+
+        feature_preds.append(relative_error_percent)
+
+    return feature_preds, log_lines
+
+
+def _fit_feature_pipelines(i, train_full, test_full, y_medians, pipelines, parameters, pipe_names):
+    """ Fits every elastic pipeline for a single signal feature,
+        returns relative errors of best fits and a log of the runs. """
+
+    # data is already imputed, so skip the finite checks every scaler/selector/model fit repeats
+    set_config(assume_finite=True)
+
+    cols = numpy.arange(train_full.shape[1])
+    X_train, X_test = train_full[:, cols != i], test_full[:, cols != i]
+    y_train, y_test = train_full[:, i], test_full[:, i]
+
+    feature_preds, log_lines = [], []
+    # try every model
+    for name in pipe_names:
+
+        start = time.time()
+        # all pipelines wrap ElasticNet, so the iteration budget itself can serve as the halving
+        # resource: bad configs are killed after a few hundred iterations, good ones get the full 5000
+        grid = HalvingGridSearchCV(pipelines[name], parameters[name], scoring=neg_median_absolute_error, cv=3, n_jobs=1,
+                                   factor=3, resource='model__max_iter', min_resources=100, max_resources=5000)
+        grid.fit(X_train, y_train)
+
+        relative_error_percent = round(-grid.best_score_ / y_medians[i] * 100, 1)
+        y_pred = grid.predict(X_test)
+        r2 = r2_score(y_test, y_pred)
+
+        log_lines.append(
+            "{} for {}: best CV score {}, median target {}, relative error {}%, r2 {}, params {}, {} seconds".format(
+                name.upper(), signal_features_names[i], grid.best_score_, y_medians[i],
+                relative_error_percent, r2, grid.best_params_, int(time.time() - start)))
+
+        feature_preds.append(relative_error_percent)
+
+    return feature_preds, log_lines
+
+
 def run_different_models(save_to):
 
     RANDOM_STATE = 2401
@@ -163,45 +308,36 @@ def run_different_models(save_to):
     signal_features = features[:, numpy.array(signal_features_indices)]
 
     # impute column-wise with median
-    for i in range(signal_features.shape[1]):
-        signal_features[numpy.where(signal_features[:, i] == -1), i] = numpy.median(signal_features[:, i])
+    signal_features = impute_missing_with_medians(signal_features)
 
     models, parameters = get_models_and_parameters(RANDOM_STATE)
     models_names = sorted(list(models.keys()))  # being paranoid
-    results = []
-
-    # fit every feature
-    for i in tqdm(range(signal_features.shape[1])):
-
-        X = numpy.delete(signal_features, i, axis=1)
-        y = signal_features[:, i]
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=RANDOM_STATE)
-
-        feature_preds = []
-        # try every model
-        for name in tqdm(models_names):
-
-            pipeline = Pipeline([
-                ('scaler', MinMaxScaler()),
-                ('selector', SelectPercentile()),
-                ('model', models[name])
-            ])
-
-            start = time.time()
-            print("Fitting {} for {}...".format(name.upper(), signal_features_names[i]))
-            grid = GridSearchCV(pipeline, parameters[name], scoring='neg_median_absolute_error', cv=3, n_jobs=-1)
-            grid.fit(X_train, y_train)
+    # the searches clone the estimators anyway, so one pipeline per model serves all features
+    pipelines = {
+        name: Pipeline([
+            ('scaler', MinMaxScaler()),
+            ('selector', SelectPercentile()),
+            ('model', models[name])
+        ], memory=pipeline_cache)
+        for name in models_names
+    }
 
-            relative_error_percent = round(-grid.best_score_ / numpy.median(y) * 100, 1)
-            print("Best parameter CV scores:", grid.best_score_)
-            print("Median target value:", numpy.median(y))
-            print("Relative error: {}%".format(relative_error_percent ))
-            print("Parameters:", grid.best_params_)
-            print(int(time.time() - start), 'seconds elapsed\n')
+    # the split depends only on the row count and the seed, so do it once and slice per feature
+    train_full, test_full = train_test_split(signal_features, test_size=0.3, random_state=RANDOM_STATE)
+    y_medians = numpy.median(signal_features, axis=0)
 
-            feature_preds.append(relative_error_percent)
+    # features are independent, so parallelize the outer loop and keep the grid searches single-threaded
+    outputs = Parallel(n_jobs=os.cpu_count(), backend='loky', return_as='generator')(
+        delayed(_fit_feature)(i, train_full, test_full, y_medians, pipelines, parameters, models_names, RANDOM_STATE)
+        for i in range(signal_features.shape[1])
+    )
 
+    results = []
+    # the output generator yields as workers finish, so the bar tracks completions, not dispatches
+    for feature_preds, log_lines in tqdm(outputs, total=signal_features.shape[1]):
+        for line in log_lines:
+            logger.info(line)
         results.append(feature_preds)
 
     results = pandas.DataFrame(results, columns=models_names, index=signal_features_names).T
@@ -219,43 +355,26 @@ def run_different_pipelines(save_to):
     signal_features = features[:, numpy.array(signal_features_indices)]
 
     # impute column-wise with median
-    for i in range(signal_features.shape[1]):
-        signal_features[numpy.where(signal_features[:, i] == -1), i] = numpy.median(signal_features[:, i])
+    signal_features = impute_missing_with_medians(signal_features)
 
     pipelines, parameters = get_elastic_pipelines(RANDOM_STATE)
     pipe_names = sorted(list(pipelines.keys()))  # being paranoid
-    results = []
-
-    # fit every feature
-    for i in tqdm(range(signal_features.shape[1])):
 
-        X = numpy.delete(signal_features, i, axis=1)
-        y = signal_features[:, i]
+    # the split depends only on the row count and the seed, so do it once and slice per feature
+    train_full, test_full = train_test_split(signal_features, test_size=0.3, random_state=RANDOM_STATE)
+    y_medians = numpy.median(signal_features, axis=0)
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=RANDOM_STATE)
-
-        feature_preds = []
-        # try every model
-        for name in tqdm(pipe_names):
-
-            start = time.time()
-            print("Fitting {} for {}...".format(name.upper(), signal_features_names[i]))
-            grid = GridSearchCV(pipelines[name], parameters[name], scoring='neg_median_absolute_error', cv=3, n_jobs=-1)
-            grid.fit(X_train, y_train)
-
-            relative_error_percent = round(-grid.best_score_ / numpy.median(y) * 100, 1)
-            y_pred = grid.predict(X_test)
-            r2 = r2_score(y_test, y_pred)
-
-            print("Best parameter CV scores:", grid.best_score_)
-            print("Median target value:", numpy.median(y))
-            print("Relative error: {}%".format(relative_error_percent))
-            print('r2 score:', r2)
-            print("Parameters:", grid.best_params_)
-            print(int(time.time() - start), 'seconds elapsed\n')
-
-            feature_preds.append(relative_error_percent)
+    # features are independent, so parallelize the outer loop and keep the grid searches single-threaded
+    outputs = Parallel(n_jobs=os.cpu_count(), backend='loky', return_as='generator')(
+        delayed(_fit_feature_pipelines)(i, train_full, test_full, y_medians, pipelines, parameters, pipe_names)
+        for i in range(signal_features.shape[1])
+    )
 
+    results = []
+    # the output generator yields as workers finish, so the bar tracks completions, not dispatches
+    for feature_preds, log_lines in tqdm(outputs, total=signal_features.shape[1]):
+        for line in log_lines:
+            logger.info(line)
         results.append(feature_preds)
 
     results = pandas.DataFrame(results, columns=pipe_names, index=signal_features_names).T
@@ -271,6 +390,9 @@ if __name__ == '__main__':
 
     save_to = '/Users/andreidm/ETH/projects/is-based-normalization/res/'
 
+    logging.basicConfig(filename=save_to + 'predictor.log', level=logging.INFO,
+                        format='%(asctime)s %(message)s')
+
     # run_different_models(save_to)
     run_different_pipelines(save_to)
 